@@ -0,0 +1,243 @@
+# async_microservices.py (m3-pyapi)
+# Asynchronous microservice classes
+
+import asyncio
+import aiohttp
+from m3_pyapi.microservices import _chunked, _clean_endpoint, AuthenticationError, AuthenticationMissingError, BadRequestError, NotFoundError, TimeoutError
+from m3_pyapi.models import from_dict, CachedAncillaryDatum, CachedVideoReferenceInfo, Media, Observation
+from typing import Iterable, List
+
+
+async def handle_status_async(response: aiohttp.ClientResponse):
+    if response.status == 200:  # OK
+        return
+    elif response.status == 400:  # Malformed request
+        raise BadRequestError(await response.text())
+    elif response.status == 404:  # Resource not found
+        raise NotFoundError(await response.text())
+    elif response.status == 504:  # Gateway timeout
+        raise TimeoutError()
+    else:
+        raise Exception(response)
+
+
+class AsyncMicroservice:
+    """ Base asynchronous microservice class """
+    def __init__(self, base_url: str):
+        self._base_url = base_url + ('/' if base_url[-1] != '/' else '')
+        self._jwt = ''
+        self._auth_header = None
+        self._session: aiohttp.ClientSession = None
+
+    async def connect(self):
+        """ Create the underlying client session, if not already open """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100, limit_per_host=30),
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+
+    async def close(self):
+        """ Close the underlying client session and its pooled connections """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def url_to(self, endpoint: str, *args) -> str:
+        """ Build the URL for an endpoint template, filling its {} placeholders with args """
+        path = _clean_endpoint(endpoint)
+        return self._base_url + (path.format(*args) if args else path)
+
+    async def _get_json(self, endpoint: str, *args, params: dict = None):
+        await self.connect()
+        async with self._session.get(self.url_to(endpoint, *args), params=params or None) as response:
+            await handle_status_async(response)
+            return await response.json(content_type=None)
+
+    async def authenticate(self, client_secret: str):
+        await self.connect()
+        async with self._session.post(self.url_to('auth'), headers={
+            'Authorization': 'APIKEY {}'.format(client_secret)
+        }) as response:
+            if response.status == 200:
+                self._jwt = (await response.json(content_type=None))['access_token']
+                self._auth_header = {'Authorization': 'BEARER {}'.format(self._jwt)}
+            else:
+                raise AuthenticationError(client_secret)
+
+    @property
+    def authenticated(self) -> bool:
+        return self._jwt != ''
+
+    def _require_authentication(self):
+        if self._auth_header is None:
+            raise AuthenticationMissingError()
+
+    @property
+    def _authorization_header(self) -> dict:
+        self._require_authentication()
+        return self._auth_header
+
+
+class AnnosaurusAsync(AsyncMicroservice):
+    """ Asynchronous Annosaurus microservice """
+    def __init__(self, base_url: str):
+        super().__init__(base_url)
+
+    # Ancillary Data ---
+    async def get_ancillary_data(self, uuid: str) -> CachedAncillaryDatum:
+        return from_dict(CachedAncillaryDatum, await self._get_json('v1/ancillarydata/{}', uuid))
+
+    async def get_ancillary_data_videoreference(self, uuid: str):
+        return await self._get_json('v1/ancillarydata/videoreference/{}', uuid)
+
+    async def get_ancillary_data_imagedmoment(self, uuid: str):
+        return await self._get_json('v1/ancillarydata/imagedmoment/{}', uuid)
+
+    async def get_ancillary_data_observation(self, uuid: str):
+        return await self._get_json('v1/ancillarydata/observation/{}', uuid)
+
+    async def get_ancillary_data_many(self, uuids: Iterable[str]) -> List[CachedAncillaryDatum]:
+        return await asyncio.gather(*[self.get_ancillary_data(uuid) for uuid in uuids])
+
+    async def _post_ancillary_data_chunk(self, chunk: List[CachedAncillaryDatum]) -> list:
+        async with self._session.post(self.url_to('v1/ancillarydata/bulk'), headers=self._authorization_header,
+                                      json=[datum.properties for datum in chunk]) as response:
+            await handle_status_async(response)
+            return await response.json(content_type=None)
+
+    async def create_ancillary_data_bulk(self, ancillary_data: Iterable[CachedAncillaryDatum], chunk_size: int = 1000,
+                                         max_concurrency: int = 4) -> list:
+        """
+        Create ancillary data in bulk, posting chunks of at most chunk_size items with up to max_concurrency in flight.
+        Chunks are pulled from ancillary_data only as requests complete. If a chunk fails, no further chunks are sent,
+        in-flight chunks are allowed to finish, and the first error is raised with a `created` attribute listing the
+        items created by the chunks that succeeded.
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1, got {}'.format(chunk_size))
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1, got {}'.format(max_concurrency))
+        self._require_authentication()
+        await self.connect()
+
+        results = {}  # chunk index -> created items
+        errors = []
+
+        async def post_chunk(index: int, chunk: List[CachedAncillaryDatum]):
+            try:
+                results[index] = await self._post_ancillary_data_chunk(chunk)
+            except Exception as e:
+                errors.append(e)
+
+        pending = set()
+        for index, chunk in enumerate(_chunked(ancillary_data, chunk_size)):
+            pending.add(asyncio.ensure_future(post_chunk(index, chunk)))
+            if len(pending) >= max_concurrency:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if errors:
+                break
+        if pending:
+            await asyncio.wait(pending)
+
+        created = [item for index in sorted(results) for item in results[index]]
+        if errors:
+            errors[0].created = created
+            raise errors[0]
+        return created
+    # ---
+
+    # Annotation (Observation) ---
+    async def get_annotation(self, uuid: str) -> Observation:
+        return from_dict(Observation, await self._get_json('v1/annotations/{}', uuid))
+
+    async def get_annotations_videoreference(self, uuid: str, **params) -> List[Observation]:
+        data = await self._get_json('v1/annotations/videoreference/{}', uuid, params=params)
+        return [from_dict(Observation, obs_item) for obs_item in data]
+
+    async def get_annotations_imagereference(self, uuid: str, **params) -> List[Observation]:
+        data = await self._get_json('v1/annotations/imagereference/{}', uuid, params=params)
+        return [from_dict(Observation, obs_item) for obs_item in data]
+
+    async def get_annotations_videoreference_chunked(self, uuid: str, **params) -> List[Observation]:
+        data = await self._get_json('v1/annotations/videoreference/chunked/{}', uuid, params=params)
+        return [from_dict(Observation, obs_item) for obs_item in data]
+
+    async def get_annotations_many(self, uuids: Iterable[str]) -> List[Observation]:
+        return await asyncio.gather(*[self.get_annotation(uuid) for uuid in uuids])
+    # ---
+
+    # Video Reference Info ---
+    async def get_vri_all(self, **params) -> List[CachedVideoReferenceInfo]:
+        data = await self._get_json('v1/videoreferences/', params=params)
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in data]
+
+    async def get_vri_uuid(self, uuid: str) -> CachedVideoReferenceInfo:
+        return from_dict(CachedVideoReferenceInfo, await self._get_json('v1/videoreferences/{}', uuid))
+
+    async def get_videoreferenceuuid_all(self) -> dict:
+        return await self._get_json('v1/videoreferences/videoreferences')
+
+    async def get_vri_videoreferenceuuid(self, uuid: str) -> List[CachedVideoReferenceInfo]:
+        data = await self._get_json('v1/videoreferences/videoreference/{}', uuid)
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in data]
+
+    async def get_missionids(self) -> dict:
+        return await self._get_json('v1/videoreferences/missionids')
+
+    async def get_vri_missionid(self, mission_id: str) -> List[CachedVideoReferenceInfo]:
+        data = await self._get_json('v1/videoreferences/missionid/{}', mission_id)
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in data]
+
+    async def get_missioncontacts(self) -> dict:
+        return await self._get_json('v1/videoreferences/missioncontacts')
+
+    async def get_vri_missioncontact(self, mission_contact: str) -> List[CachedVideoReferenceInfo]:
+        data = await self._get_json('v1/videoreferences/missioncontact/{}', mission_contact)
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in data]
+    # ---
+
+
+class VampireSquidAsync(AsyncMicroservice):
+    """ Asynchronous Vampire Squid microservice """
+    def __init__(self, base_url: str):
+        super().__init__(base_url)
+
+    async def get_media_videoreference(self, uuid: str) -> Media:
+        return from_dict(Media, await self._get_json('v1/media/videoreference/{}', uuid))
+
+    async def get_media_videoreference_filename(self, filename: str) -> Media:
+        return from_dict(Media, await self._get_json('v1/media/videoreference/filename/{}', filename))
+
+    async def get_media_videosequence_name(self, name: str) -> List[Media]:
+        data = await self._get_json('v1/media/videosequence/{}', name)
+        return [from_dict(Media, media_item) for media_item in data]
+
+    async def get_media_video(self, name: str) -> List[Media]:
+        data = await self._get_json('v1/media/video/{}', name)
+        return [from_dict(Media, media_item) for media_item in data]
+
+    async def get_media_camera_timestamps(self, camera_id: str, start_time: str, end_time: str) -> List[Media]:
+        data = await self._get_json('v1/media/camera/{}/{}/{}', camera_id, start_time, end_time)
+        return [from_dict(Media, media_item) for media_item in data]
+
+    async def get_media_concurrent(self, uuid: str) -> List[Media]:
+        data = await self._get_json('v1/media/concurrent/{}', uuid)
+        return [from_dict(Media, media_item) for media_item in data]
+
+    async def get_media_camera_datetime(self, camera_id: str, date_time: str) -> List[Media]:
+        data = await self._get_json('v1/media/camera/{}/{}', camera_id, date_time)
+        return [from_dict(Media, media_item) for media_item in data]
+
+    async def get_media_uri(self, uri: str) -> Media:
+        return from_dict(Media, await self._get_json('v1/media/uri/{}', uri))
+
+    async def get_media_many(self, uuids: Iterable[str]) -> List[Media]:
+        return await asyncio.gather(*[self.get_media_videoreference(uuid) for uuid in uuids])
@@ -0,0 +1,108 @@
+# cache.py (m3-pyapi)
+# In-process caching of idempotent requests
+
+import copy
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+
+class TTLCache:
+    """ Thread-safe LRU cache whose entries expire after a time-to-live """
+    def __init__(self, maxsize: int = 512, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """ Get a cached value, raising KeyError if missing or expired """
+        with self._lock:
+            expiry, value = self._data[key]
+            if expiry < time.monotonic():
+                del self._data[key]
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            return value
+
+    def get_stale(self, key) -> tuple:
+        """ Get a cached value and whether it is still fresh, keeping expired entries; raises KeyError if missing """
+        with self._lock:
+            expiry, value = self._data[key]
+            self._data.move_to_end(key)
+            return value, expiry >= time.monotonic()
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _CachedError:
+    """ Cached exception outcome, storing the exception type and args rather than the shared instance """
+    def __init__(self, error: Exception):
+        self.error_type = type(error)
+        self.args = error.args
+
+    def build(self) -> Exception:
+        """ Create a fresh exception instance with the cached type and args """
+        # Bypass the subclass __init__, which may reformat its message (e.g. NotFoundError prefixes 'Not found: ')
+        error = self.error_type.__new__(self.error_type)
+        error.args = self.args
+        return error
+
+
+def make_key(func, args, kwargs) -> tuple:
+    """ Build a cache key from a function and its call arguments """
+    return func.__qualname__, repr(args), repr(sorted(kwargs.items()))
+
+
+def ttl_lru(maxsize: int = 512, ttl: float = 60, negative_ttl: float = None, negative_exceptions: tuple = ()):
+    """
+    Memoize a function with an LRU cache whose entries expire after ttl seconds.
+    The cache keeps its own deep copy of each result and returns deep copies on hit, so callers may mutate results.
+    If negative_ttl is given, raised negative_exceptions are also cached (for negative_ttl seconds) and re-raised on hit.
+    """
+    def decorator(func):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(func, args, kwargs)
+            try:
+                value = cache.get(key)
+            except KeyError:
+                pass
+            else:
+                if isinstance(value, _CachedError):
+                    raise value.build()
+                return copy.deepcopy(value)
+
+            try:
+                value = func(*args, **kwargs)
+            except negative_exceptions as e:
+                if negative_ttl is not None:
+                    cache.set(key, _CachedError(e), ttl=negative_ttl)
+                raise
+            # Copy before storing so the cached entry never aliases an object handed to a caller
+            cache.set(key, copy.deepcopy(value))
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
@@ -1,10 +1,26 @@
 # microservices.py (m3-pyapi)
 # Microservice classes
 
-import json
+import copy
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from m3_pyapi.cache import TTLCache, ttl_lru
 from m3_pyapi.models import from_dict, CachedAncillaryDatum, CachedVideoReferenceInfo, ImageParams, Media, Observation, ImagedMoment, ImageReference, Association
-from typing import Iterable, List
+from typing import Callable, Iterable, List
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib parser
+    orjson = None
+
+try:
+    import httpx
+except ImportError:  # httpx is optional, only needed for transport='httpx'
+    httpx = None
 
 
 class AuthenticationError(Exception):
@@ -37,35 +53,168 @@ class TimeoutError(Exception):
         super().__init__('Gateway timeout')
 
 
-def handle_status(response: requests.Response):
+def handle_status(response):
     if response.status_code == 200:  # OK
         return
     elif response.status_code == 400:  # Malformed request
         raise BadRequestError(response.content.decode())
     elif response.status_code == 404:  # Resource not found
         raise NotFoundError(response.content.decode())
-    elif response.status_code == 504:  # Gateway timeout
+    elif response.status_code == 504:  # Gateway timeout (after any retries are exhausted)
         raise TimeoutError()
     else:
         raise Exception(response)
 
 
+@lru_cache(maxsize=256)
+def _clean_endpoint(endpoint: str) -> str:
+    """ Strip empty segments (leading, trailing and repeated slashes) from a constant endpoint template """
+    return '/'.join(filter(bool, endpoint.split('/')))
+
+
+def _parse(response):
+    """ Parse a JSON response body, using orjson when available """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+# (service repr, cache key) -> ({validator header: value}, parsed body), revalidated once expired
+_CONDITIONAL_CACHE = TTLCache(maxsize=256, ttl=60)
+
+
+def _chunked(iterable: Iterable, chunk_size: int):
+    """ Yield successive lists of at most chunk_size items from an iterable """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class Microservice:
-    """ Base microservice class """
-    def __init__(self, base_url: str):
+    """
+    Base microservice class.
+    transport selects the HTTP client: 'requests' (default) or 'httpx' (HTTP/2, requires httpx[http2]).
+    Transport-level failures surface as that client's exceptions: requests.RequestException or httpx.HTTPError.
+    """
+    def __init__(self, base_url: str, transport: str = 'requests'):
         self._base_url = base_url + ('/' if base_url[-1] != '/' else '')
         self._jwt = ''
+        self._auth_header = None
+        self._transport = transport
+
+        if transport == 'httpx':
+            if httpx is None:
+                raise ImportError("transport='httpx' requires httpx[http2] to be installed")
+            # Requests are multiplexed over HTTP/2, so a small keep-alive pool suffices
+            # No timeout and following redirects, matching requests.Session defaults
+            self._session = httpx.Client(
+                http2=True,
+                base_url=self._base_url,
+                limits=httpx.Limits(max_keepalive_connections=10),
+                timeout=None,
+                follow_redirects=True
+            )
+            return
+        elif transport != 'requests':
+            raise ValueError('Unknown transport: {}'.format(transport))
+
+        self._session = requests.Session()
+        # Retry idempotent requests with exponential backoff, honoring Retry-After.
+        # Once retries are exhausted the last response is returned for handle_status.
+        retry = Retry(
+            total=5,
+            backoff_factor=0.2,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=frozenset(['GET', 'PUT', 'HEAD']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=20)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def close(self):
+        """ Close the underlying session and its pooled connections """
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self) -> str:
+        # Used in cache keys, so instances pointing at the same service share entries
+        return '{}({!r})'.format(type(self).__name__, self._base_url)
+
+    def map(self, fn: Callable, args_list: Iterable, max_workers: int = 16) -> list:
+        """ Call fn on each argument concurrently, sharing this service's pooled session """
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(fn, args_list))
+
+    def _stream_get(self, url: str):
+        """ Context manager for a streamed GET response """
+        if self._transport == 'httpx':
+            return self._session.stream('GET', url)
+        return self._session.get(url, stream=True)
+
+    def _handle_stream_status(self, response):
+        if self._transport == 'httpx' and response.status_code != 200:
+            response.read()  # httpx requires streamed bodies to be read before accessing content
+        handle_status(response)
 
-    def url_to(self, endpoint: str) -> str:
-        endpoint_parts = filter(bool, endpoint.split('/'))
-        return self._base_url + '/'.join(endpoint_parts)
+    def _iter_chunks(self, response, chunk_size: int = 65536):
+        if self._transport == 'httpx':
+            return response.iter_bytes(chunk_size)
+        return response.iter_content(chunk_size=chunk_size)
+
+    def _cond_get(self, endpoint: str, cache_key: str = None, ttl: float = None):
+        """
+        GET a JSON endpoint through the conditional cache, revalidating expired entries with ETag/Last-Modified.
+        Returns a deep copy of the cached body, so callers may mutate it.
+        """
+        key = (repr(self), cache_key or endpoint)
+        try:
+            (validators, value), fresh = _CONDITIONAL_CACHE.get_stale(key)
+        except KeyError:
+            validators, value, fresh = None, None, False
+        if fresh:
+            return copy.deepcopy(value)
+
+        headers = {}
+        if validators:
+            if 'ETag' in validators:
+                headers['If-None-Match'] = validators['ETag']
+            if 'Last-Modified' in validators:
+                headers['If-Modified-Since'] = validators['Last-Modified']
+
+        response = self._session.get(self.url_to(endpoint), headers=headers)
+        if response.status_code == 304 and validators:  # Not modified, keep the cached body
+            _CONDITIONAL_CACHE.set(key, (validators, value), ttl=ttl)
+            return copy.deepcopy(value)
+
+        handle_status(response)
+        value = _parse(response)
+        validators = {name: response.headers[name] for name in ('ETag', 'Last-Modified') if name in response.headers}
+        _CONDITIONAL_CACHE.set(key, (validators, copy.deepcopy(value)), ttl=ttl)
+        return value
+
+    def url_to(self, endpoint: str, *args) -> str:
+        """ Build the URL for an endpoint template, filling its {} placeholders with args """
+        path = _clean_endpoint(endpoint)
+        return self._base_url + (path.format(*args) if args else path)
 
     def authenticate(self, client_secret: str):
-        response = requests.post(self.url_to('auth'), headers = {
+        response = self._session.post(self.url_to('auth'), headers = {
             'Authorization': 'APIKEY {}'.format(client_secret)
         })
         if response.status_code == 200:
             self._jwt = response.json()['access_token']
+            self._auth_header = {'Authorization': 'BEARER {}'.format(self._jwt)}
+            self._session.headers.update(self._auth_header)
         else:
             raise AuthenticationError(client_secret)
     
@@ -73,180 +222,215 @@ class Microservice:
     def authenticated(self) -> bool:
         return self._jwt != ''
 
-    @property
-    def _authorization_header(self) -> dict:
-        if not self.authenticated:
+    def _require_authentication(self):
+        if self._auth_header is None:
             raise AuthenticationMissingError()
-        return {'Authorization': 'BEARER {}'.format(self._jwt)}
 
 
 class Annosaurus(Microservice):
     """ Annosaurus microservice """
-    def __init__(self, base_url: str):
-        super().__init__(base_url)
+    def __init__(self, base_url: str, transport: str = 'requests'):
+        super().__init__(base_url, transport)
     
     # Ancillary Data ---
+    @ttl_lru()
     def get_ancillary_data(self, uuid: str) -> CachedAncillaryDatum:
-        response = requests.get(self.url_to('v1/ancillarydata/{}'.format(uuid)))
+        response = self._session.get(self.url_to('v1/ancillarydata/{}', uuid))
         handle_status(response)
-        return from_dict(CachedAncillaryDatum, response.json())
+        return from_dict(CachedAncillaryDatum, _parse(response))
+
+    def get_ancillary_data_many(self, uuids: Iterable[str]) -> List[CachedAncillaryDatum]:
+        return self.map(self.get_ancillary_data, uuids)
     
     def get_ancillary_data_videoreference(self, uuid: str):
-        response = requests.get(self.url_to('v1/ancillarydata/videoreference/{}'.format(uuid)))
+        response = self._session.get(self.url_to('v1/ancillarydata/videoreference/{}', uuid))
         handle_status(response)
-        return response.json()
+        return _parse(response)
 
     def get_ancillary_data_imagedmoment(self, uuid: str):
-        response = requests.get(self.url_to('v1/ancillarydata/imagedmoment/{}'.format(uuid)))
+        response = self._session.get(self.url_to('v1/ancillarydata/imagedmoment/{}', uuid))
         handle_status(response)
-        return response.json()
+        return _parse(response)
 
     def get_ancillary_data_observation(self, uuid: str):
-        response = requests.get(self.url_to('v1/ancillarydata/observation/{}'.format(uuid)))
+        response = self._session.get(self.url_to('v1/ancillarydata/observation/{}', uuid))
         handle_status(response)
-        return response.json()
+        return _parse(response)
 
     def create_ancillary_datum(self, ancillary_datum: CachedAncillaryDatum):
-        response = requests.post(self.url_to('v1/ancillarydata'), headers=self._authorization_header, data=ancillary_datum.properties)
+        self._require_authentication()
+        response = self._session.post(self.url_to('v1/ancillarydata'), data=ancillary_datum.properties)
         handle_status(response)
-        return response.json()
+        Annosaurus.get_ancillary_data.cache.clear()
+        return _parse(response)
     
-    def create_ancillary_data_bulk(self, ancillary_data: Iterable[CachedAncillaryDatum]):
-        headers = self._authorization_header
-        json_data = json.dumps([datum.properties for datum in ancillary_data])
-        response = requests.post(self.url_to('v1/ancillarydata/bulk'), headers=headers, json=json_data)
-        handle_status(response)
-        return response.json()
+    def create_ancillary_data_bulk(self, ancillary_data: Iterable[CachedAncillaryDatum], chunk_size: int = 1000) -> list:
+        """
+        Create ancillary data in bulk, posting at most chunk_size items per request.
+        Partial success is possible: if a chunk fails, the raised error has a `created` attribute listing the items
+        created by the preceding chunks.
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1, got {}'.format(chunk_size))
+        self._require_authentication()
+        created = []
+        try:
+            for chunk in _chunked(ancillary_data, chunk_size):
+                response = self._session.post(self.url_to('v1/ancillarydata/bulk'), json=[datum.properties for datum in chunk])
+                handle_status(response)
+                created.extend(_parse(response))
+        except Exception as e:
+            e.created = created
+            raise
+        finally:
+            Annosaurus.get_ancillary_data.cache.clear()
+        return created
     
     def merge_ancillary_data(self, uuid: str, ancillary_data: Iterable[CachedAncillaryDatum], window: int = 0):
-        headers = self._authorization_header
+        self._require_authentication()
         params = {'window': window} if window > 0 else None
-        json_data = json.dumps([datum.properties for datum in ancillary_data])
-        requests.put(self.url_to('v1/ancillarydata/merge/{}'.format(uuid)), headers=headers, params=params, json=json_data)
+        payload = [datum.properties for datum in ancillary_data]
+        self._session.put(self.url_to('v1/ancillarydata/merge/{}', uuid), params=params, json=payload)
+        Annosaurus.get_ancillary_data.cache.clear()
     # ---
 
     # Annotation (Observation) ---
     # TODO Annotation PUT, POST requests
+    @ttl_lru(ttl=10)
     def get_annotation(self, uuid: str) -> Observation:
-        response = requests.get(self.url_to('v1/annotations/{}'.format(uuid)))
-        return from_dict(Observation, response.json())
+        response = self._session.get(self.url_to('v1/annotations/{}', uuid))
+        handle_status(response)
+        return from_dict(Observation, _parse(response))
+
+    def get_annotations_many(self, uuids: Iterable[str]) -> List[Observation]:
+        return self.map(self.get_annotation, uuids)
 
     def get_annotations_videoreference(self, uuid: str, **params) -> List[Observation]:
-        response = requests.get(self.url_to('v1/annotations/videoreference/{}'.format(uuid)), params=params)
-        return [from_dict(Observation, obs_item) for obs_item in response.json()]
+        response = self._session.get(self.url_to('v1/annotations/videoreference/{}', uuid), params=params)
+        return [from_dict(Observation, obs_item) for obs_item in _parse(response)]
     
     def get_annotations_imagereference(self, uuid: str, **params) -> List[Observation]:
-        response = requests.get(self.url_to('v1/annotations/imagereference/{}'.format(uuid)), params=params)
-        return [from_dict(Observation, obs_item) for obs_item in response.json()]
+        response = self._session.get(self.url_to('v1/annotations/imagereference/{}', uuid), params=params)
+        return [from_dict(Observation, obs_item) for obs_item in _parse(response)]
 
     def get_annotations_videoreference_chunked(self, uuid: str, **params) -> List[Observation]:
-        response = requests.get(self.url_to('v1/annotations/videoreference/chunked/{}'.format(uuid)), params=params)
-        return [from_dict(Observation, obs_item) for obs_item in response.json()]
+        response = self._session.get(self.url_to('v1/annotations/videoreference/chunked/{}', uuid), params=params)
+        return [from_dict(Observation, obs_item) for obs_item in _parse(response)]
     # ---
 
     # Video Reference Info ---
     # TODO Video reference info PUT, POST, DELETE requests
     def get_vri_all(self, **params) -> List[CachedVideoReferenceInfo]:
-        response = requests.get(self.url_to('v1/videoreferences/'), params=params)
-        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in response.json()]
+        response = self._session.get(self.url_to('v1/videoreferences/'), params=params)
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in _parse(response)]
     
+    @ttl_lru()
     def get_vri_uuid(self, uuid: str) -> CachedVideoReferenceInfo:
-        response = requests.get(self.url_to('v1/videoreferences/{}'.format(uuid)))
-        return from_dict(CachedVideoReferenceInfo, response.json())
+        response = self._session.get(self.url_to('v1/videoreferences/{}', uuid))
+        handle_status(response)
+        return from_dict(CachedVideoReferenceInfo, _parse(response))
     
     def get_videoreferenceuuid_all(self) -> dict:
-        response = requests.get(self.url_to('v1/videoreferences/videoreferences'))
-        return response.json()
+        return self._cond_get('v1/videoreferences/videoreferences')
     
     def get_vri_videoreferenceuuid(self, uuid: str) -> List[CachedVideoReferenceInfo]:
-        response = requests.get(self.url_to('v1/videoreferences/videoreference/{}'.format(uuid)))
-        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in response.json()]
+        response = self._session.get(self.url_to('v1/videoreferences/videoreference/{}', uuid))
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in _parse(response)]
 
     def get_missionids(self) -> dict:
-        response = requests.get(self.url_to('v1/videoreferences/missionids'))
-        return response.json()
+        return self._cond_get('v1/videoreferences/missionids', ttl=3600)
     
     def get_vri_missionid(self, mission_id: str) -> List[CachedVideoReferenceInfo]:
-        response = requests.get(self.url_to('v1/videoreferences/missionid/{}'.format(mission_id)))
-        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in response.json()]
+        response = self._session.get(self.url_to('v1/videoreferences/missionid/{}', mission_id))
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in _parse(response)]
 
     def get_missioncontacts(self) -> dict:
-        response = requests.get(self.url_to('v1/videoreferences/missioncontacts'))
-        return response.json()
+        return self._cond_get('v1/videoreferences/missioncontacts', ttl=3600)
     
     def get_vri_missioncontact(self, mission_contact: str) -> List[CachedVideoReferenceInfo]:
-        response = requests.get(self.url_to('v1/videoreferences/missioncontact/{}'.format(mission_contact)))
-        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in response.json()]
+        response = self._session.get(self.url_to('v1/videoreferences/missioncontact/{}', mission_contact))
+        return [from_dict(CachedVideoReferenceInfo, vri_item) for vri_item in _parse(response)]
     # ---
 
 
 class Panoptes(Microservice):
     """ Panoptes microservice """
-    def __init__(self, base_url: str):
-        super().__init__(base_url)
+    def __init__(self, base_url: str, transport: str = 'requests'):
+        super().__init__(base_url, transport)
     
     def upload_framegrab(self, image_file: str, camera_id: str, deployment_id: str, name: str):
-        files = {'file': open(image_file, 'rb')}
-        response = requests.post(self.url_to('v1/images/{}/{}/{}'.format(camera_id, deployment_id, name)), headers=self._authorization_header, files=files)
+        self._require_authentication()
+        with open(image_file, 'rb') as f:
+            response = self._session.post(self.url_to('v1/images/{}/{}/{}', camera_id, deployment_id, name), files={'file': f})
         handle_status(response)
-        return ImageParams(response.json())
+        Panoptes.get_framegrab.cache.clear()
+        return ImageParams(_parse(response))
 
+    @ttl_lru(negative_ttl=5, negative_exceptions=(NotFoundError,))
     def get_framegrab(self, camera_id: str, deployment_id: str, name: str):
-        response = requests.get(self.url_to('v1/images/{}/{}/{}'.format(camera_id, deployment_id, name)))
+        response = self._session.get(self.url_to('v1/images/{}/{}/{}', camera_id, deployment_id, name))
         handle_status(response)
-        return from_dict(ImageParams, response.json())
+        return from_dict(ImageParams, _parse(response))
 
     def download_framegrab(self, image_file: str, camera_id: str, deployment_id: str, name: str):
-        response = requests.get(self.url_to('v1/images/download/{}/{}/{}'.format(camera_id, deployment_id, name)))
-        with open(image_file, 'wb') as f:
-            f.write(response.content)
+        with self._stream_get(self.url_to('v1/images/download/{}/{}/{}', camera_id, deployment_id, name)) as response:
+            self._handle_stream_status(response)
+            with open(image_file, 'wb') as f:
+                for chunk in self._iter_chunks(response):
+                    f.write(chunk)
 
 
 class VampireSquid(Microservice):
     """ Vampire Squid microservice """
-    def __init__(self, base_url: str):
-        super().__init__(base_url)
+    def __init__(self, base_url: str, transport: str = 'requests'):
+        super().__init__(base_url, transport)
 
+    @ttl_lru()
     def get_media_videoreference(self, uuid: str) -> Media:
-        response = requests.get(self.url_to('v1/media/videoreference/{}'.format(uuid)))
+        response = self._session.get(self.url_to('v1/media/videoreference/{}', uuid))
         handle_status(response)
-        return from_dict(Media, response.json())
+        return from_dict(Media, _parse(response))
+
+    def get_media_videoreference_many(self, uuids: Iterable[str]) -> List[Media]:
+        return self.map(self.get_media_videoreference, uuids)
 
+    @ttl_lru(negative_ttl=5, negative_exceptions=(NotFoundError,))
     def get_media_videoreference_filename(self, filename: str) -> Media:
-        response = requests.get(self.url_to('v1/media/videoreference/filename/{}'.format(filename)))
+        response = self._session.get(self.url_to('v1/media/videoreference/filename/{}', filename))
         handle_status(response)
-        return from_dict(Media, response.json())
+        return from_dict(Media, _parse(response))
 
     def get_media_videosequence_name(self, name: str) -> List[Media]:
-        response = requests.get(self.url_to('v1/media/videosequence/{}'.format(name)))
+        response = self._session.get(self.url_to('v1/media/videosequence/{}', name))
         handle_status(response)
-        return [from_dict(Media, media_item) for media_item in response.json()]
+        return [from_dict(Media, media_item) for media_item in _parse(response)]
 
     def get_media_video(self, name: str) -> List[Media]:
-        response = requests.get(self.url_to('v1/media/video/{}'.format(name)))
+        response = self._session.get(self.url_to('v1/media/video/{}', name))
         handle_status(response)
-        return [from_dict(Media, media_item) for media_item in response.json()]
+        return [from_dict(Media, media_item) for media_item in _parse(response)]
 
     def get_media_camera_timestamps(self, camera_id: str, start_time: str, end_time: str) -> List[Media]:
-        response = requests.get(self.url_to('v1/media/camera/{}/{}/{}'.format(camera_id, start_time, end_time)))
+        response = self._session.get(self.url_to('v1/media/camera/{}/{}/{}', camera_id, start_time, end_time))
         handle_status(response)
-        return [from_dict(Media, media_item) for media_item in response.json()]
+        return [from_dict(Media, media_item) for media_item in _parse(response)]
 
     def get_media_concurrent(self, uuid: str) -> List[Media]:
-        response = requests.get(self.url_to('v1/media/concurrent/{}'.format(uuid)))
+        response = self._session.get(self.url_to('v1/media/concurrent/{}', uuid))
         handle_status(response)
-        return [from_dict(Media, media_item) for media_item in response.json()]
+        return [from_dict(Media, media_item) for media_item in _parse(response)]
 
     def get_media_camera_datetime(self, camera_id: str, date_time: str) -> List[Media]:
         # TODO Make this use python datetime objects
-        response = requests.get(self.url_to('v1/media/camera/{}/{}'.format(camera_id, date_time)))
+        response = self._session.get(self.url_to('v1/media/camera/{}/{}', camera_id, date_time))
         handle_status(response)
-        return [from_dict(Media, media_item) for media_item in response.json()]
+        return [from_dict(Media, media_item) for media_item in _parse(response)]
     
+    @ttl_lru(negative_ttl=5, negative_exceptions=(NotFoundError,))
     def get_media_uri(self, uri: str) -> Media:
-        response = requests.get(self.url_to('v1/media/uri/{}'.format(uri)))
+        response = self._session.get(self.url_to('v1/media/uri/{}', uri))
         handle_status(response)
-        return from_dict(Media, response.json())
+        return from_dict(Media, _parse(response))
 
 
 
@@ -1,20 +1,136 @@
 # models.py (m3-pyapi)
 # M3 data models
 
-from dataclasses import dataclass, asdict, fields
-from typing import List
+from dataclasses import dataclass, fields, is_dataclass, MISSING
+from typing import List, get_args, get_origin
+
+
+_FIELD_CACHE = {}  # dataclass type -> {field name: field type}
+_BUILDER_CACHE = {}  # dataclass type -> generated dict-to-dataclass constructor
+_CONVERTER_CACHE = {}  # non-dataclass type (e.g. List[X]) -> converter or None
+_SCALAR_TYPES = frozenset((str, int, float, bool))
+
+
+def _field_map(dtype) -> dict:
+    """ Get the (cached) field name to type map of a dataclass """
+    field_map = _FIELD_CACHE.get(dtype)
+    if field_map is None:
+        field_map = _FIELD_CACHE[dtype] = {field.name: field.type for field in fields(dtype)}
+    return field_map
+
+
+def _converter(ftype):
+    """ Get a function converting raw values of the given field type, or None if no conversion is needed """
+    if is_dataclass(ftype):
+        def convert(val):
+            return _builder(ftype)(val) if isinstance(val, dict) else val
+        return convert
+
+    if get_origin(ftype) is list:
+        inner_args = get_args(ftype)
+        inner = inner_args[0] if inner_args else None
+        if is_dataclass(inner):
+            def convert_list(val):
+                if not isinstance(val, list):
+                    return val
+                build = _builder(inner)
+                return [build(item) if isinstance(item, dict) else item for item in val]
+            return convert_list
+
+    return None
+
+
+def _builder(dtype):
+    """ Get (generating on first use) a specialized dict-to-dataclass constructor for dtype """
+    build = _BUILDER_CACHE.get(dtype)
+    if build is not None:
+        return build
+
+    _field_map(dtype)
+    namespace = {'_dtype': dtype}
+    args = []
+    for field in fields(dtype):
+        name = field.name
+        if field.default is not MISSING:
+            namespace['_default_' + name] = field.default
+            expr = 'get({!r}, _default_{})'.format(name, name)
+        elif field.default_factory is not MISSING:
+            namespace['_factory_' + name] = field.default_factory
+            expr = 'd[{0!r}] if {0!r} in d else _factory_{0}()'.format(name)
+        else:
+            expr = 'd[{!r}]'.format(name)
+
+        convert = None if isinstance(dtype.__dict__.get(name), _LazyList) else _converter(field.type)
+        if convert is not None:
+            namespace['_convert_' + name] = convert
+            expr = '_convert_{}({})'.format(name, expr)
+        args.append('{}={}'.format(name, expr))
+
+    source = 'def _build_{}(d):\n    get = d.get\n    return _dtype({})\n'.format(dtype.__name__, ', '.join(args))
+    exec(source, namespace)
+    build = _BUILDER_CACHE[dtype] = namespace['_build_' + dtype.__name__]
+    return build
+
+
+class _LazyList:
+    """ Descriptor wrapping a dataclass slot whose raw list of dicts is converted on first access """
+    def __init__(self, slot, item_type):
+        self._slot = slot
+        self._item_type = item_type
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = self._slot.__get__(obj, objtype)
+        if value and isinstance(value, list) and isinstance(value[0], dict):
+            build = _builder(self._item_type)
+            value = [build(item) if isinstance(item, dict) else item for item in value]
+            self._slot.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        self._slot.__set__(obj, value)
+
+
+def _make_lazy(dtype, *names):
+    """ Defer conversion of the given List[dataclass] fields of dtype until they are accessed """
+    for name in names:
+        item_type = get_args(_field_map(dtype)[name])[0]
+        setattr(dtype, name, _LazyList(dtype.__dict__[name], item_type))
+
+
+def _properties_getter(dtype):
+    """ Generate a function returning the non-None fields of a dtype instance as a dict """
+    lines = ['def _properties_{}(self):'.format(dtype.__name__), '    r = {}']
+    for name in _field_map(dtype):
+        lines.append('    v = self.{}'.format(name))
+        lines.append('    if v is not None: r[{!r}] = v'.format(name))
+    lines.append('    return r')
+    namespace = {}
+    exec('\n'.join(lines) + '\n', namespace)
+    return namespace['_properties_' + dtype.__name__]
 
 
 def from_dict(dtype, data):
     """ Recursively generate a dataclass from a dict """
-    try:
-        field_map = {field.name: field.type for field in fields(dtype)}
-        return dtype(**{key: from_dict(field_map[key], val) for key, val in data.items()})
-    except:
+    if data is None or dtype in _SCALAR_TYPES:
         return data
 
+    if is_dataclass(dtype):
+        if not isinstance(data, dict):
+            return data
+        try:
+            return _builder(dtype)(data)
+        except TypeError as e:
+            raise TypeError('Cannot build {} from {!r}'.format(dtype.__name__, data)) from e
 
-@dataclass
+    if dtype not in _CONVERTER_CACHE:
+        _CONVERTER_CACHE[dtype] = _converter(dtype)
+    convert = _CONVERTER_CACHE[dtype]
+    return data if convert is None else convert(data)
+
+
+@dataclass(slots=True)
 class CachedAncillaryDatum:
     uuid: str = None
     imaged_moment_uuid: str = None
@@ -46,19 +162,17 @@ class CachedAncillaryDatum:
     theta: float = None
     psi: float = None
 
-    @property
-    def properties(self):
-        return {k: v for k, v in asdict(self).items() if v is not None}
+    # properties (dict of non-None fields) is generated below
 
 
-@dataclass
+@dataclass(slots=True)
 class ImageListing:
     cameraId: str = None
     deploymentId: str = None
     files: List[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ImageParams:
     uri: str = None
     cameraId: str = None
@@ -66,7 +180,7 @@ class ImageParams:
     name: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Media:
     video_sequence_uuid: str = None
     video_reference_uuid: str = None
@@ -88,7 +202,7 @@ class Media:
     sha512: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class CachedVideoReferenceInfo:
     mission_contact: str = None
     platform_name: str = None
@@ -98,7 +212,7 @@ class CachedVideoReferenceInfo:
     uuid: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Association:
     link_name: str = None
     link_value: str = None
@@ -107,7 +221,7 @@ class Association:
     uuid: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ImageReference:
     description: str = None
     url: str = None
@@ -117,7 +231,7 @@ class ImageReference:
     uuid: str = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Observation:
     observation_uuid: str = None
     concept: str = None
@@ -133,7 +247,7 @@ class Observation:
     image_references: List[ImageReference] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ImagedMoment:
     recorded_date: str = None
     timecode: str = None
@@ -143,3 +257,14 @@ class ImagedMoment:
     ancillary_data: CachedAncillaryDatum = None
     last_updated_time: str = None
     uuid: str = None
+
+
+# Observation associations and image references are only built when accessed
+_make_lazy(Observation, 'associations', 'image_references')
+
+# Generate constructors for all models up front
+for _dtype in (CachedAncillaryDatum, ImageListing, ImageParams, Media, CachedVideoReferenceInfo,
+               Association, ImageReference, Observation, ImagedMoment):
+    _builder(_dtype)
+
+CachedAncillaryDatum.properties = property(_properties_getter(CachedAncillaryDatum))